@@ -1,11 +1,16 @@
 # app.py
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, g, jsonify, request, render_template, stream_with_context
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
 import logging
+import threading
 
-from db import init_db, upsert_indicator, record_feed_run_start, record_feed_run_end, get_connection
+from db import (init_db, filter_changed_indicators, upsert_indicators_bulk,
+                record_feed_run_start, record_feed_run_end, acquire_reader, release_reader,
+                get_writer, utc_now)
 from feeds import fetch_urlhaus_recent, fetch_spamhaus_all
 
 app = Flask(__name__)
@@ -15,40 +20,40 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("mini-tip")
 
 # --- Feed runner helpers ---
-def run_urlhaus_job():
-    run_id = record_feed_run_start("urlhaus")
-    count = 0
+def _run_feed_job(source: str, fetch, label: str):
+    started_at = utc_now()
     try:
-        indicators = fetch_urlhaus_recent()
-        for ind in indicators:
-            upsert_indicator(ind)
-            count += 1
-        record_feed_run_end(run_id, count, "success", None)
-        logger.info(f"URLhaus job: ingested {count} indicators.")
+        indicators = fetch()
+        # Run bookkeeping and the upserts commit (or roll back) as one transaction
+        with get_writer() as conn, conn:
+            run_id = record_feed_run_start(source, conn, started_at)
+            # Rows identical to what is stored would be no-op upserts; skip them
+            changed = filter_changed_indicators(indicators, conn)
+            written = upsert_indicators_bulk(changed, conn)
+            record_feed_run_end(run_id, len(indicators), "success", None, conn)
+        logger.info(f"{label} job: ingested {len(indicators)} indicators ({written} new or changed).")
     except Exception as e:
-        record_feed_run_end(run_id, count, "error", str(e))
-        logger.exception("URLhaus job failed")
+        # Nothing from the failed run was committed, so record it as 0 ingested
+        with get_writer() as conn, conn:
+            run_id = record_feed_run_start(source, conn, started_at)
+            record_feed_run_end(run_id, 0, "error", str(e), conn)
+        logger.exception(f"{label} job failed")
+
+def run_urlhaus_job():
+    _run_feed_job("urlhaus", fetch_urlhaus_recent, "URLhaus")
 
 def run_spamhaus_job():
-    run_id = record_feed_run_start("spamhaus")
-    count = 0
-    try:
-        indicators = fetch_spamhaus_all()
-        for ind in indicators:
-            upsert_indicator(ind)
-            count += 1
-        record_feed_run_end(run_id, count, "success", None)
-        logger.info(f"Spamhaus job: ingested {count} indicators.")
-    except Exception as e:
-        record_feed_run_end(run_id, count, "error", str(e))
-        logger.exception("Spamhaus job failed")
+    _run_feed_job("spamhaus", fetch_spamhaus_all, "Spamhaus")
 
 def run_all_feeds():
-    run_urlhaus_job()
-    run_spamhaus_job()
+    # The feeds are independent and network-bound: fetch them side by side.
+    # Their DB writes still take turns on the shared writer connection.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda job: job(), [run_urlhaus_job, run_spamhaus_job]))
 
 # --- Scheduler setup ---
-scheduler = BackgroundScheduler()
+# A small thread pool lets the hourly and 6-hourly jobs overlap when they line up
+scheduler = BackgroundScheduler(executors={"default": {"type": "threadpool", "max_workers": 4}})
 
 def start_scheduler():
     # Fetch URLhaus every hour; Spamhaus every 6 hours (they change less often)
@@ -58,74 +63,156 @@ def start_scheduler():
     logger.info("Scheduler started.")
 
 # --- Flask routes ---
+def get_reader():
+    # One pooled reader per request, handed back in _release_reader
+    if "reader" not in g:
+        g.reader = acquire_reader()
+    return g.reader
+
+@app.teardown_request
+def _release_reader(exc):
+    conn = g.pop("reader", None)
+    if conn is not None:
+        release_reader(conn)
+
 @app.route("/")
 def home():
     # Show a minimal UI
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as c FROM indicators;")
-    total = cur.fetchone()["c"]
-
-    cur.execute("SELECT COUNT(*) as c FROM indicators WHERE type='url';")
-    total_urls = cur.fetchone()["c"]
-    cur.execute("SELECT COUNT(*) as c FROM indicators WHERE type='cidr';")
-    total_cidrs = cur.fetchone()["c"]
-    cur.execute("SELECT COUNT(*) as c FROM indicators WHERE source LIKE 'spamhaus%';")
-    total_spamhaus = cur.fetchone()["c"]
-    cur.execute("SELECT COUNT(*) as c FROM indicators WHERE source='urlhaus';")
-    total_urlhaus = cur.fetchone()["c"]
-
-    conn.close()
+    # One pass over indicators for all the dashboard counters
+    cur = get_reader().cursor()
+    cur.execute("""
+        SELECT COUNT(*) AS total,
+               COALESCE(SUM(type='url'), 0) AS urls,
+               COALESCE(SUM(type='cidr'), 0) AS cidrs,
+               COALESCE(SUM(source LIKE 'spamhaus%'), 0) AS spamhaus,
+               COALESCE(SUM(source='urlhaus'), 0) AS urlhaus
+        FROM indicators;
+    """)
+    row = cur.fetchone()
+
     return render_template("index.html",
-                           total=total,
-                           total_urls=total_urls,
-                           total_cidrs=total_cidrs,
-                           total_spamhaus=total_spamhaus,
-                           total_urlhaus=total_urlhaus)
+                           total=row["total"],
+                           total_urls=row["urls"],
+                           total_cidrs=row["cidrs"],
+                           total_spamhaus=row["spamhaus"],
+                           total_urlhaus=row["urlhaus"])
 
 @app.route("/health")
 def health():
     return jsonify({"status": "ok"})
 
+# The trigram tokenizer needs at least 3 characters to match anything
+FTS_MIN_QUERY_LEN = 3
+STREAM_BATCH_SIZE = 500  # rows serialized per chunk of the /indicators response
+
+@lru_cache(maxsize=None)
+def _indicators_sql(q_mode: str, has_type: bool, has_source: bool, has_after: bool) -> str:
+    # Only a handful of filter combinations exist; building each SQL string once
+    # keeps the text identical across requests, so sqlite3's statement cache can reuse it.
+    # q_mode: "" (no search), "fts" (trigram index) or "like" (short queries).
+    # SQLite renders each row as a JSON object, so Python never builds a dict per row
+    sql = """SELECT json_object('id', id, 'type', type, 'value', value, 'source', source,
+                                'first_seen', first_seen, 'last_seen', last_seen, 'tags', tags,
+                                'confidence', confidence, 'status', status)
+             FROM indicators WHERE 1=1"""
+    if q_mode == "fts":
+        sql += " AND id IN (SELECT rowid FROM indicators_fts WHERE indicators_fts MATCH ?)"
+    elif q_mode == "like":
+        sql += " AND value LIKE ?"
+    if has_type:
+        sql += " AND type = ?"
+    if has_source:
+        sql += " AND source = ?"
+    if has_after:
+        sql += " AND (last_seen, id) < (?, ?)"
+    # id breaks ties between rows from the same fetch (they share last_seen)
+    sql += " ORDER BY last_seen DESC, id DESC LIMIT ?"
+    return sql
+
 @app.route("/indicators")
 def indicators():
     """
     Returns JSON of indicators with basic filters:
       /indicators?q=evil.com&type=url&source=urlhaus&limit=50
+    Newest first. For the next page pass the last row's last_seen and id back as
+      /indicators?...&after_last_seen=<last_seen>&after_id=<id>
     """
     q = request.args.get("q", "").strip()
     type_ = request.args.get("type", "").strip()
     source = request.args.get("source", "").strip()
     limit = int(request.args.get("limit", 50))
+    after_last_seen = request.args.get("after_last_seen", "").strip()
+    after_id = int(request.args.get("after_id", 0))
 
-    sql = "SELECT type, value, source, first_seen, last_seen, tags, confidence, status FROM indicators WHERE 1=1"
     params = []
-    if q:
-        sql += " AND value LIKE ?"
+    q_mode = ""
+    if len(q) >= FTS_MIN_QUERY_LEN:
+        # Quote as an FTS5 string so the whole query is matched as a substring
+        q_mode = "fts"
+        params.append('"' + q.replace('"', '""') + '"')
+    elif q:
+        q_mode = "like"
         params.append(f"%{q}%")
     if type_:
-        sql += " AND type = ?"
         params.append(type_)
     if source:
-        sql += " AND source = ?"
         params.append(source)
-    sql += " ORDER BY last_seen DESC LIMIT ?"
+    if after_last_seen:
+        params += [after_last_seen, after_id]
     params.append(limit)
+    sql = _indicators_sql(q_mode, bool(type_), bool(source), bool(after_last_seen))
 
-    conn = get_connection()
-    cur = conn.cursor()
+    cur = get_reader().cursor()
+    cur.row_factory = None  # plain tuples: each row is just its JSON text
     cur.execute(sql, params)
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return jsonify(rows)
+
+    def generate():
+        # Stream the JSON array in batches instead of building it in one piece
+        # The reader goes back to the pool once the stream ends (stream_with_context
+        # keeps the request alive until then); close the cursor first so no
+        # half-read statement travels with it if the client disconnects.
+        try:
+            yield "["
+            sep = ""
+            while batch := cur.fetchmany(STREAM_BATCH_SIZE):
+                yield sep + ",".join(r[0] for r in batch)
+                sep = ","
+            yield "]"
+        finally:
+            cur.close()
+
+    return app.response_class(stream_with_context(generate()), mimetype="application/json")
+
+# Held from the moment a manual run is accepted until it finishes, so repeated
+# clicks can't queue overlapping downloads of every feed.
+_manual_run_lock = threading.Lock()
+
+def _run_manual_feeds():
+    try:
+        run_all_feeds()
+    finally:
+        _manual_run_lock.release()
 
 @app.route("/feeds/run", methods=["POST"])
 def manual_run():
     """
-    Manually kick off both feeds (synchronous, simple demo).
+    Manually kick off both feeds. The run is handed to the scheduler's thread
+    pool and the request returns 202 straight away; the outcome is recorded
+    in feed_runs (and the logs). Returns 409 while a manual run is pending or
+    running, and 503 when the scheduler isn't running to execute it.
     """
-    run_all_feeds()
-    return jsonify({"message": "Feeds fetched."})
+    if not scheduler.running:
+        return jsonify({"message": "Scheduler is not running; feeds can't be fetched."}), 503
+    if not _manual_run_lock.acquire(blocking=False):
+        return jsonify({"message": "A feed run is already in progress."}), 409
+    try:
+        # misfire_grace_time=None: a late start must still run, or the lock would never be released
+        scheduler.add_job(_run_manual_feeds, id="manual_run", replace_existing=True,
+                          next_run_time=datetime.now(), misfire_grace_time=None)
+    except Exception:
+        _manual_run_lock.release()
+        raise
+    return jsonify({"message": "Feed run scheduled."}), 202
 
 if __name__ == "__main__":
     # Important in dev: avoid Flask reloader starting scheduler twice
@@ -1,20 +1,91 @@
 # db.py
+import atexit
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
+from itertools import islice
 
 DB_PATH = Path("tip.db")
+UPSERT_BATCH_SIZE = 500  # rows per executemany() call
+READER_POOL_SIZE = 4  # idle reader connections kept open between requests
 
-def get_connection():
+def get_connection(check_same_thread: bool = True):
     # Connect to SQLite and return rows as dict-like objects
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES,
+                           check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
+    # Per-connection tuning: WAL only needs NORMAL sync, keep temp data and a
+    # bigger page cache in memory, and wait on locks held by the scheduler
+    # thread instead of failing with "database is locked".
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA busy_timeout=5000")
     return conn
 
+# ---- Connection pool ----
+# One shared writer connection (writes are serialized by _writer_lock) and a
+# small pool of reader connections that requests check out and hand back.
+# Connections stay open across requests so SQLite keeps its page cache and
+# prepared statements warm. Readers aren't tied to a thread, because the dev
+# server starts a new thread for every request.
+_writer_conn: sqlite3.Connection | None = None
+_writer_lock = threading.RLock()
+_reader_pool: queue.LifoQueue = queue.LifoQueue(maxsize=READER_POOL_SIZE)
+
+@contextmanager
+def get_writer():
+    """
+    Hold the writer lock and yield the shared writer connection.
+    Callers are responsible for committing (e.g. `with get_writer() as conn, conn:`).
+    """
+    global _writer_conn
+    with _writer_lock:
+        if _writer_conn is None:
+            _writer_conn = get_connection(check_same_thread=False)
+        yield _writer_conn
+
+def acquire_reader() -> sqlite3.Connection:
+    """Check out an idle reader connection, opening a new one if none is free."""
+    try:
+        return _reader_pool.get_nowait()
+    except queue.Empty:
+        return get_connection(check_same_thread=False)
+
+def release_reader(conn: sqlite3.Connection):
+    """Return a reader to the pool; beyond READER_POOL_SIZE idle ones it is closed."""
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _reader_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@atexit.register
+def close_pool():
+    global _writer_conn
+    with _writer_lock:
+        if _writer_conn is not None:
+            _writer_conn.close()
+            _writer_conn = None
+    while True:
+        try:
+            _reader_pool.get_nowait().close()
+        except queue.Empty:
+            break
+
 def init_db():
     conn = get_connection()
     cur = conn.cursor()
 
+    # WAL lets Flask readers run while a feed job is writing; the setting is
+    # stored in the database file, so it only has to be enabled once.
+    cur.execute("PRAGMA journal_mode=WAL")
+
     # indicators: stores threat indicators
     cur.execute("""
     CREATE TABLE IF NOT EXISTS indicators (
@@ -27,11 +98,59 @@ def init_db():
         tags TEXT,
         confidence INTEGER DEFAULT 50 CHECK(confidence BETWEEN 0 AND 100),
         status TEXT DEFAULT 'active',
+        net_start BLOB,
+        net_end BLOB,
         UNIQUE(value, source)
     );
     """)
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_indicators_value ON indicators(value);")
+    # Databases created before net_start/net_end existed get them added here
+    columns = {row["name"] for row in cur.execute("PRAGMA table_info(indicators);")}
+    for column in ("net_start", "net_end"):
+        if column not in columns:
+            cur.execute(f"ALTER TABLE indicators ADD COLUMN {column} BLOB;")
+    # Lookups by value are served by the UNIQUE(value, source) autoindex, whose
+    # leading column is value; a separate value index only doubled write cost.
+    cur.execute("DROP INDEX IF EXISTS idx_indicators_value;")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_indicators_type ON indicators(type);")
+    # Ascending on purpose: scanned backwards it yields (last_seen DESC, id DESC),
+    # which is the /indicators ordering, without a sort step.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_indicators_last_seen ON indicators(last_seen);")
+    # Same idea per source: /indicators?source=... (optionally with type, a short
+    # LIKE or a keyset cursor) walks only that source's rows, newest first.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_indicators_source_last_seen ON indicators(source, last_seen);")
+    # CIDR containment: WHERE ? BETWEEN net_start AND net_end (see feeds.ip_key)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_indicators_net_range ON indicators(net_start, net_end);")
+
+    # indicators_fts: trigram index over indicators.value for substring search.
+    # External-content table kept in sync by triggers; only changes to value
+    # touch it, so the usual upsert (last_seen/tags/...) leaves it alone.
+    fts_exists = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='indicators_fts'"
+    ).fetchone()
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS indicators_fts USING fts5(
+        value, content='indicators', content_rowid='id', tokenize='trigram'
+    );
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS indicators_fts_ai AFTER INSERT ON indicators BEGIN
+        INSERT INTO indicators_fts(rowid, value) VALUES (new.id, new.value);
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS indicators_fts_ad AFTER DELETE ON indicators BEGIN
+        INSERT INTO indicators_fts(indicators_fts, rowid, value) VALUES ('delete', old.id, old.value);
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS indicators_fts_au AFTER UPDATE OF value ON indicators BEGIN
+        INSERT INTO indicators_fts(indicators_fts, rowid, value) VALUES ('delete', old.id, old.value);
+        INSERT INTO indicators_fts(rowid, value) VALUES (new.id, new.value);
+    END;
+    """)
+    if not fts_exists:
+        # Index rows that were ingested before the FTS table existed
+        cur.execute("INSERT INTO indicators_fts(indicators_fts) VALUES ('rebuild');")
 
     # feed_runs: tracks each fetch attempt (for visibility/debugging)
     cur.execute("""
@@ -46,9 +165,34 @@ def init_db():
     );
     """)
 
+    # Refresh planner statistics so the composite indexes above get picked
+    cur.execute("ANALYZE;")
+
     conn.commit()
     conn.close()
 
+# Kept as one constant string so every call hands sqlite3 the identical SQL text
+# and the compiled statement is reused from the writer connection's cache.
+_UPSERT_SQL = """
+INSERT INTO indicators (type, value, source, first_seen, last_seen, tags, confidence, status,
+                        net_start, net_end)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(value, source) DO UPDATE SET
+    last_seen=excluded.last_seen,
+    tags=excluded.tags,
+    status=excluded.status,
+    confidence=excluded.confidence,
+    net_start=excluded.net_start,
+    net_end=excluded.net_end
+"""
+
+def _upsert_params(ind) -> tuple:
+    return (
+        ind["type"], ind["value"], ind["source"], ind.get("first_seen"),
+        ind.get("last_seen"), ind.get("tags",""), ind.get("confidence",50),
+        ind.get("status","active"), ind.get("net_start"), ind.get("net_end")
+    )
+
 def upsert_indicator(ind):
     """
     ind = {
@@ -59,48 +203,111 @@ def upsert_indicator(ind):
       "last_seen":  same as above,
       "tags": "comma,separated" or "",
       "confidence": int 0-100,
-      "status": "active"|"inactive"
+      "status": "active"|"inactive",
+      "net_start": 16-byte range key or None (cidr only, see feeds.ip_key),
+      "net_end":   same as above
     }
     """
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-    INSERT INTO indicators (type, value, source, first_seen, last_seen, tags, confidence, status)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ON CONFLICT(value, source) DO UPDATE SET
-        last_seen=excluded.last_seen,
-        tags=excluded.tags,
-        status=excluded.status,
-        confidence=excluded.confidence
-    """, (
-        ind["type"], ind["value"], ind["source"], ind.get("first_seen"),
-        ind.get("last_seen"), ind.get("tags",""), ind.get("confidence",50),
-        ind.get("status","active")
-    ))
-    conn.commit()
-    conn.close()
+    with get_writer() as conn, conn:
+        conn.execute(_UPSERT_SQL, _upsert_params(ind))
 
-def record_feed_run_start(source: str) -> int:
-    conn = get_connection()
+def upsert_indicators_bulk(indicators, conn: sqlite3.Connection | None = None) -> int:
+    """
+    Upsert many indicators (same shape as upsert_indicator) in one transaction.
+    Rows are sent to executemany() in chunks of UPSERT_BATCH_SIZE so a large
+    feed never has to be materialized as one huge parameter list.
+    Pass conn to join a transaction already open on the writer connection.
+    Returns the number of indicators written.
+    """
+    if conn is None:
+        with get_writer() as conn, conn:
+            return upsert_indicators_bulk(indicators, conn)
+
+    params = (_upsert_params(ind) for ind in indicators)
+    count = 0
     cur = conn.cursor()
-    now = datetime.utcnow().isoformat() + "Z"
-    cur.execute("""
+    while True:
+        batch = list(islice(params, UPSERT_BATCH_SIZE))
+        if not batch:
+            break
+        cur.executemany(_UPSERT_SQL, batch)
+        count += len(batch)
+    return count
+
+def filter_changed_indicators(indicators, conn: sqlite3.Connection | None = None) -> list[dict]:
+    """
+    Return only the indicators whose upsert would change something: new
+    (value, source) pairs, or existing ones whose last_seen, tags, status,
+    confidence or network range differ from what is stored. Duplicates within
+    the batch are collapsed the way sequential upserts would leave them: the
+    last occurrence's values, but type and first_seen from the first one.
+    """
+    latest: dict[tuple, dict] = {}
+    for ind in indicators:
+        key = (ind["value"], ind["source"])
+        first = latest.get(key)
+        if first is not None:
+            ind = {**ind, "type": first["type"], "first_seen": first.get("first_seen")}
+        latest[key] = ind
+    if not latest:
+        return []
+    if conn is None:
+        with get_writer() as conn:
+            return filter_changed_indicators(list(latest.values()), conn)
+    sources = sorted({source for _, source in latest})
+
+    # Spamhaus and the URLhaus text fallback stamp last_seen with the fetch
+    # time, so every row is newer than anything stored and none can be
+    # skipped. One indexed MAX per source detects that without loading rows.
+    last_seens = [ind.get("last_seen") for ind in latest.values()]
+    if None not in last_seens:
+        newest_stored = max(
+            (conn.execute("SELECT MAX(last_seen) FROM indicators WHERE source=?", (source,)).fetchone()[0]
+             for source in sources),
+            key=lambda v: v or "",
+        )
+        if newest_stored is None or min(last_seens) > newest_stored:
+            return list(latest.values())
+
+    # Load the stored state of every source in this batch once
+    placeholders = ",".join("?" * len(sources))
+    stored = {
+        (row[0], row[1]): tuple(row[2:])
+        for row in conn.execute(f"""
+            SELECT value, source, last_seen, tags, status, confidence, net_start, net_end
+            FROM indicators WHERE source IN ({placeholders})
+        """, sources)
+    }
+    return [
+        ind for key, ind in latest.items()
+        if stored.get(key) != (ind.get("last_seen"), ind.get("tags",""),
+                               ind.get("status","active"), ind.get("confidence",50),
+                               ind.get("net_start"), ind.get("net_end"))
+    ]
+
+def utc_now() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+# The feed_runs helpers commit on their own by default; pass the writer
+# connection as conn to make them part of a larger transaction instead.
+def record_feed_run_start(source: str, conn: sqlite3.Connection | None = None,
+                          started_at: str | None = None) -> int:
+    if conn is None:
+        with get_writer() as conn, conn:
+            return record_feed_run_start(source, conn, started_at)
+    cur = conn.execute("""
         INSERT INTO feed_runs (source, started_at, status)
         VALUES (?, ?, ?)
-    """, (source, now, "running"))
-    conn.commit()
-    run_id = cur.lastrowid
-    conn.close()
-    return run_id
+    """, (source, started_at or utc_now(), "running"))
+    return cur.lastrowid
 
-def record_feed_run_end(run_id: int, items_ingested: int, status: str, error_text: str | None = None):
-    conn = get_connection()
-    cur = conn.cursor()
-    now = datetime.utcnow().isoformat() + "Z"
-    cur.execute("""
+def record_feed_run_end(run_id: int, items_ingested: int, status: str, error_text: str | None = None,
+                        conn: sqlite3.Connection | None = None):
+    if conn is None:
+        with get_writer() as conn, conn:
+            return record_feed_run_end(run_id, items_ingested, status, error_text, conn)
+    conn.execute("""
         UPDATE feed_runs
         SET finished_at=?, items_ingested=?, status=?, error_text=?
         WHERE id=?
-    """, (now, items_ingested, status, error_text, run_id))
-    conn.commit()
-    conn.close()
+    """, (utc_now(), items_ingested, status, error_text, run_id))
@@ -15,13 +15,20 @@ Each fetch_* function returns a list of normalized "indicator" dicts:
   "tags": "comma,separated",
   "confidence": int (0-100),
   "status": "active" | "inactive",
+  "net_start": bytes | None,  # cidr only: 16-byte range keys, see ip_key()
+  "net_end":   bytes | None,
 }
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Iterable
 from datetime import datetime, timezone
+from itertools import chain
 import csv
-import io
+import ipaddress
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---- URLhaus ----
 # CSV (recent) and plain-text (recent) endpoints
@@ -34,40 +41,73 @@ SPAMHAUS_EDROP  = "https://www.spamhaus.org/drop/edrop.txt"    # IPv4 (extended)
 SPAMHAUS_DROPV6 = "https://www.spamhaus.org/drop/dropv6.txt"   # IPv6 CIDRs
 
 REQUEST_TIMEOUT = 25  # seconds
+_HTML_PREFIXES = ("<!doctype", "<html")  # block-page sniffing, see fetch_urlhaus_recent
 UA = "mini-tip/0.1 (+https://github.com/alexv199/mini-tip; educational)"  # change if you like
 
+# Shared session: keeps TCP/TLS connections alive between fetches and retries
+# transient failures a couple of times before giving up.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.3),
+))
+_SESSION.headers.update({"User-Agent": UA, "Accept-Encoding": "gzip, deflate"})
+
 
 def _utc_now_iso() -> str:
     """UTC timestamp in ISO 8601 with 'Z' suffix."""
     return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
 
 
+def ip_key(address: ipaddress.IPv4Address | ipaddress.IPv6Address) -> bytes:
+    """
+    16-byte big-endian key used for net_start/net_end. IPv4 is mapped into
+    ::ffff:0:0/96 so both families share one ordering (IPv6 doesn't fit in
+    SQLite's 64-bit INTEGER, hence bytes), and a lookup is simply
+    "WHERE ip_key(addr) BETWEEN net_start AND net_end".
+    """
+    if address.version == 4:
+        return (0xFFFF << 32 | int(address)).to_bytes(16, "big")
+    return address.packed
+
+
 # -----------------------------
 # URLhaus helpers / main fetcher
 # -----------------------------
-def _parse_urlhaus_csv(text: str) -> list[dict]:
+def _parse_urlhaus_csv(lines: Iterable[str]) -> list[dict]:
     """
-    Parse URLhaus CSV content.
+    Parse URLhaus CSV content, given as an iterable of lines (e.g. a streamed response).
     Skips comment lines beginning with '#', normalizes headers to lowercase.
     """
     # Keep only non-comment lines; header appears after the banner comments.
-    rows = [ln for ln in text.splitlines() if ln.strip() and not ln.lstrip().startswith("#")]
-    if not rows:
+    # (first-character tests, so skipped lines cost no string copies)
+    rows = (ln for ln in lines if ln and ln[0] != "#" and not ln.isspace())
+    reader = csv.reader(rows)
+    header = next(reader, None)
+    if header is None:
         return []
 
-    reader = csv.DictReader(io.StringIO("\n".join(rows)))
-    out: list[dict] = []
+    # Some columns may vary in case; resolve column positions once from the header
+    idx = {name.strip().lower(): i for i, name in enumerate(header)}
+    i_url = idx.get("url", -1)
+    i_dateadded = idx.get("dateadded", -1)
+    i_firstseen = idx.get("firstseen", -1)
+    i_url_status = idx.get("url_status", -1)
+    i_status = idx.get("status", -1)
+    i_tags = idx.get("tags", -1)
 
-    for row in reader:
-        # Some columns may vary in case; normalize keys
-        low = { (k or "").strip().lower(): (v or "").strip() for k, v in row.items() }
+    def col(row: list[str], i: int) -> str:
+        return row[i].strip() if 0 <= i < len(row) else ""
 
-        url = low.get("url") or ""
+    out: list[dict] = []
+    for row in reader:
+        url = col(row, i_url)
         if not url:
             continue
 
-        dateadded = low.get("dateadded") or low.get("firstseen") or _utc_now_iso()
-        status_field = (low.get("url_status") or low.get("status") or "").lower()
+        dateadded = col(row, i_dateadded) or col(row, i_firstseen) or _utc_now_iso()
+        status_field = (col(row, i_url_status) or col(row, i_status)).lower()
         status = "inactive" if status_field == "offline" else "active"
 
         out.append({
@@ -76,7 +116,7 @@ def _parse_urlhaus_csv(text: str) -> list[dict]:
             "source": "urlhaus",
             "first_seen": dateadded,
             "last_seen": dateadded,
-            "tags": low.get("tags", ""),
+            "tags": col(row, i_tags),
             "confidence": 80,
             "status": status,
         })
@@ -90,10 +130,10 @@ def _parse_urlhaus_text(text: str) -> list[dict]:
     out: list[dict] = []
     now = _utc_now_iso()
     for ln in text.splitlines():
-        s = ln.strip()
-        if not s or s.startswith("#"):
+        if not ln or ln[0] == "#":
             continue
-        if s.startswith("http://") or s.startswith("https://"):
+        s = ln.strip()
+        if s.startswith(("http://", "https://")):
             out.append({
                 "type": "url",
                 "value": s,
@@ -112,26 +152,26 @@ def fetch_urlhaus_recent() -> list[dict]:
     Try URLhaus CSV first; if we parse 0 rows, fall back to the text feed.
     Raises for HTTP errors; returns [] if no indicators parsed.
     """
-    headers = {
-        "User-Agent": UA,
-        "Accept": "text/csv, text/plain;q=0.9, */*;q=0.8",
-    }
+    headers = {"Accept": "text/csv, text/plain;q=0.9, */*;q=0.8"}
 
-    # Attempt CSV
-    r = requests.get(URLHAUS_RECENT_CSV, headers=headers, timeout=REQUEST_TIMEOUT)
-    r.raise_for_status()
+    # Attempt CSV, streamed line by line so the multi-MB body is never held as one string
+    with _SESSION.get(URLHAUS_RECENT_CSV, headers=headers, timeout=REQUEST_TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        r.encoding = r.encoding or "utf-8"
+        lines = r.iter_lines(decode_unicode=True)
 
-    # If a block page (HTML) ever appears, bail clearly rather than silently returning 0.
-    first = r.text.lstrip().lower()
-    if first.startswith("<!doctype") or first.startswith("<html"):
-        raise RuntimeError("URLhaus returned HTML (possible block page).")
+        # If a block page (HTML) ever appears, bail clearly rather than silently returning 0.
+        # Only a short prefix is inspected, however long the first line is.
+        first = next((ln for ln in lines if ln and not ln.isspace()), "")
+        if first[:64].lstrip().lower().startswith(_HTML_PREFIXES):
+            raise RuntimeError("URLhaus returned HTML (possible block page).")
 
-    indicators = _parse_urlhaus_csv(r.text)
+        indicators = _parse_urlhaus_csv(chain([first], lines))
     if indicators:
         return indicators
 
     # Fallback: plain-text feed
-    r2 = requests.get(URLHAUS_RECENT_TXT, headers=headers, timeout=REQUEST_TIMEOUT)
+    r2 = _SESSION.get(URLHAUS_RECENT_TXT, headers=headers, timeout=REQUEST_TIMEOUT)
     r2.raise_for_status()
     return _parse_urlhaus_text(r2.text)
 
@@ -148,13 +188,19 @@ def _parse_spamhaus_text(text: str, source_name: str) -> list[dict]:
     indicators: list[dict] = []
     now = _utc_now_iso()
     for raw in text.splitlines():
-        raw = raw.strip()
-        if not raw or raw.startswith(";"):
+        if not raw or raw[0] == ";":
+            continue
+        # First token on the line is the CIDR (split() also skips leading whitespace)
+        parts = raw.split(None, 1)
+        if not parts:
             continue
-        # First token on the line is the CIDR
-        cidr = raw.split()[0]
+        cidr = parts[0]
         if "/" not in cidr:
             continue
+        try:
+            net = ipaddress.ip_network(cidr, strict=False)
+        except ValueError:
+            continue
         indicators.append({
             "type": "cidr",
             "value": cidr,
@@ -164,6 +210,8 @@ def _parse_spamhaus_text(text: str, source_name: str) -> list[dict]:
             "tags": "drop-list",
             "confidence": 70,
             "status": "active",
+            "net_start": ip_key(net.network_address),
+            "net_end": ip_key(net.broadcast_address),
         })
     return indicators
 
@@ -172,16 +220,25 @@ def fetch_spamhaus_all() -> list[dict]:
     """
     Fetch Spamhaus DROP, EDROP, and DROPv6 lists and return CIDR indicators.
     """
-    headers = {"User-Agent": UA, "Accept": "text/plain"}
-    indicators: list[dict] = []
-
-    for url, name in [
+    headers = {"Accept": "text/plain"}
+    lists = [
         (SPAMHAUS_DROP,   "spamhaus-drop"),
         (SPAMHAUS_EDROP,  "spamhaus-edrop"),
         (SPAMHAUS_DROPV6, "spamhaus-dropv6"),
-    ]:
-        resp = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    ]
+
+    # The three lists are independent downloads from the same host: fetch them
+    # concurrently; the shared session's pool keeps the connections alive.
+    def _get(url: str) -> str:
+        resp = _SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
         resp.raise_for_status()
-        indicators.extend(_parse_spamhaus_text(resp.text, name))
+        return resp.text
+
+    with ThreadPoolExecutor(max_workers=len(lists)) as executor:
+        bodies = list(executor.map(_get, [url for url, _ in lists]))
+
+    indicators: list[dict] = []
+    for (_, name), body in zip(lists, bodies):
+        indicators.extend(_parse_spamhaus_text(body, name))
 
     return indicators